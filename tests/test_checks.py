@@ -0,0 +1,36 @@
+# Runs the maintenance checks the way an admin would (python main.py COMMAND), on copies of the shipped DBs
+import os
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+@pytest.fixture
+def scratch_env(tmp_path):
+    # Environment pointing main.py at scratch copies of library.db and users.db, so the checks never touch the real files
+    for name in ("library.db", "users.db"):
+        shutil.copy(os.path.join(ROOT, name), tmp_path / name)
+    return dict(os.environ, SLMS_LIBRARY_DB=str(tmp_path / "library.db"), SLMS_USERS_DB=str(tmp_path / "users.db"))
+
+def run(env, *args):
+    return subprocess.run([sys.executable, os.path.join(ROOT, "main.py"), *args], env=env, capture_output=True, text=True, timeout=600)
+
+def test_check_concurrency(scratch_env):
+    result = run(scratch_env, "check-concurrency")
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert "FAILED" not in result.stdout
+
+def test_check_double_lending(scratch_env):
+    result = run(scratch_env, "check-double-lending", "8")
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert "FAILED" not in result.stdout
+
+def test_audit_plans(scratch_env, tmp_path):
+    # Generates its own small library in a scratch directory, the plans are also written out for the failure message
+    plans_path = tmp_path / "plans.json"
+    result = run(scratch_env, "audit-plans", "small", str(plans_path))
+    assert result.returncode == 0, result.stdout[-4000:] + result.stderr
+    assert plans_path.exists()